@@ -1,16 +1,15 @@
 import os
-import json
-import re
+import orjson
 import logging
-import tempfile
+import itertools
 from datetime import datetime, timezone, timedelta
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-from bs4 import BeautifulSoup
+from html import unescape
+import httpx
+import re2
+from lxml import etree
+import lxml.html
 import pandas as pd
 import gspread
-from gspread_dataframe import set_with_dataframe
 import time
 import random
 from gspread.exceptions import APIError
@@ -19,6 +18,38 @@ URL = "https://galeri24.co.id/harga-emas"
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
 SHEET_ID = "1BCR_IbhFWSIR1faz9UJXItLHSOicaSWofymvDCSuq_E"
 WORKSHEET_NAME = "Galeri24"
+TS_COL_IDX = 0 # timestamp is always the first column written by scrape()
+LAST_TS_PATH = ".last_ts"
+VALID_IDS = frozenset(["GALERI 24", "ANTAM", "Dinar G24", "ANTAM NON PEGADAIAN", "UBS"]) # Insert more gold brand here, check DIV id on the website
+
+SECTION_XPATH = etree.XPath(
+    "//div[" + " or ".join(f"@id='{brand}'" for brand in sorted(VALID_IDS)) + "]"
+)
+# same class set as the old div.grid.grid-cols-5.divide-x.lg:hover:bg-neutral-50.transition-all
+# selector; only the hoverable data rows carry all of them, header rows do not
+ROW_CLASSES = ("grid", "grid-cols-5", "divide-x", "lg:hover:bg-neutral-50", "transition-all")
+ROW_XPATH = etree.XPath(
+    ".//div[" + " and ".join(
+        f"contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')" for cls in ROW_CLASSES
+    ) + "]"
+)
+CELL_XPATH = etree.XPath(".//div")
+# fast path over the raw bytes for the flat row markup, parse_sections_lxml() is the fallback
+# Latin-1 mode so every byte matches [^"] even where the page is not valid UTF-8
+_RE2_OPTIONS = re2.Options()
+_RE2_OPTIONS.encoding = re2.Options.Encoding.LATIN1
+SECTION_START_RE = re2.compile(rb'<div\b[^>]*?\sid="([^"]*)"', _RE2_OPTIONS)
+DIV_TAG_RE = re2.compile(rb'<(/?)div\b[^>]*>', _RE2_OPTIONS)
+# re2 has no lookahead, so the class tokens are captured and checked against
+# ROW_CLASSES in Python, the same set ROW_XPATH requires
+_DIV_CLASS = rb'<div\b[^>]*?\sclass="([^"]*)"[^>]*>'
+DIV_CLASS_RE = re2.compile(_DIV_CLASS, _RE2_OPTIONS)
+ROW_RE = re2.compile(
+    _DIV_CLASS + rb'\s*<div[^>]*>([^<]+)</div>\s*<div[^>]*>([^<]+)</div>\s*<div[^>]*>([^<]+)</div>\s*</div>',
+    _RE2_OPTIONS,
+)
+_ROW_CLASS_TOKENS = frozenset(cls.encode() for cls in ROW_CLASSES)
+_PRICE_DELETE = str.maketrans("", "", "Rp. ,\t\r\n\xa0") # "Rp\xa01.234.567" -> "1234567"
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
@@ -42,81 +73,144 @@ def retry_gspread(func, max_attempts=5, base_sleep=5):
             )
             time.sleep(sleep)
 
-def create_session(retries=3, backoff=0.3, status_forcelist=(500, 502, 503, 504)):
-    s = requests.Session()
-    s.headers.update({"User-Agent": USER_AGENT})
-    retry = Retry(
-        total=retries,
-        backoff_factor=backoff,
-        status_forcelist=status_forcelist,
-        allowed_methods=frozenset(["GET", "POST"])
+def create_client(retries=3):
+    # transport retries cover connect failures only; read errors, timeouts and
+    # status codes are retried in fetch(). ConnectTimeout is retried at both
+    # layers, so one fetch() can make up to (retries + 1) ** 2 = 16 connect attempts.
+    return httpx.Client(
+        headers={"User-Agent": USER_AGENT, "Accept": "text/html", "Accept-Encoding": "br, gzip"},
+        timeout=10.0,
+        follow_redirects=True,
+        transport=httpx.HTTPTransport(http2=True, retries=retries),
     )
-    s.mount("https://", HTTPAdapter(max_retries=retry))
-    s.mount("http://", HTTPAdapter(max_retries=retry))
-    return s
 
-def parse_currency_to_int(text):
-    if not text or not isinstance(text, str):
-        return None
-    m = re.search(r"([\d\.\,]+)", text)
-    if not m:
-        return None
-    num = m.group(1).replace(".", "").replace(",", "")
-    try:
-        return int(num)
-    except ValueError:
-        return None
+CLIENT = create_client()
 
-def parse_table(container_div, brand, timestamp_iso):
+def fetch(url, retries=3, backoff=0.5, status_forcelist=(429, 500, 502, 503, 504)):
+    for attempt in range(retries + 1):
+        try:
+            resp = CLIENT.get(url)
+        except (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError) as e:
+            # ConnectError has already been retried by the transport
+            if isinstance(e, httpx.ConnectError) or attempt == retries:
+                raise
+            reason = repr(e)
+            sleep = backoff * 2 ** attempt
+        else:
+            if resp.status_code not in status_forcelist or attempt == retries:
+                return resp
+            retry_after = resp.headers.get("Retry-After", "")
+            reason = f"HTTP {resp.status_code}"
+            sleep = float(retry_after) if retry_after.isascii() and retry_after.isdigit() else backoff * 2 ** attempt
+
+        logging.warning(
+            "%s from %s. Retrying in %.1fs (attempt %d/%d)",
+            reason, url, sleep, attempt + 1, retries
+        )
+        time.sleep(sleep)
+
+def parse_table(container_div):
     parsed = []
-    rows = container_div.select("div.grid.grid-cols-5.divide-x.lg\\:hover\\:bg-neutral-50.transition-all")
-    for row in rows:
-        cols = [col.get_text(strip=True) for col in row.select("div")]
+    for row in ROW_XPATH(container_div):
+        cols = [col.text_content().strip() for col in CELL_XPATH(row)]
         if len(cols) == 3:
-            weight, jual, buyback = cols
-            parsed.append([timestamp_iso, brand, weight, jual, buyback])
+            parsed.append(cols)
+    return parsed
+
+def parse_sections_lxml(content):
+    parsed = []
+    for sec in SECTION_XPATH(lxml.html.fromstring(content)):
+        brand = sec.get("id")
+        try:
+            parsed.append((brand, parse_table(sec)))
+        except Exception as e:
+            logging.warning("Failed to parse section %s: %s", brand, e)
     return parsed
 
+def find_div_end(content, start):
+    # offset just past the </div> closing the div opened at start, None if unbalanced
+    depth = 0
+    for m in DIV_TAG_RE.finditer(content, start):
+        depth += -1 if m.group(1) else 1
+        if depth == 0:
+            return m.end()
+    return None
+
+def parse_sections_fast(content):
+    parsed = []
+    for m in SECTION_START_RE.finditer(content):
+        brand = m.group(1).decode("utf-8", "replace")
+        if brand not in VALID_IDS:
+            continue
+        end = find_div_end(content, m.start())
+        if end is None:
+            return None
+        chunk = content[m.start():end]
+        rows = [
+            [unescape(cell.decode("utf-8", "replace")).strip() for cell in m.groups()[1:]]
+            for m in ROW_RE.finditer(chunk)
+            if _ROW_CLASS_TOKENS.issubset(m.group(1).split())
+        ]
+        row_divs = sum(1 for m in DIV_CLASS_RE.finditer(chunk) if _ROW_CLASS_TOKENS.issubset(m.group(1).split()))
+        if not rows or len(rows) != row_divs:
+            return None  # some row is not flat 3-cell markup, let lxml handle the page
+        parsed.append((brand, rows))
+    return parsed or None
+
 def scrape():
-    s = create_session()
     try:
-        resp = s.get(URL, timeout=10)
+        resp = fetch(URL)
         resp.raise_for_status()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error("Request failed: %s", e)
         raise
 
-    soup = BeautifulSoup(resp.text, "html.parser")
-    timestamp_iso = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
+    timestamp_iso = now.isoformat()
+    timestamp_local = (now + timedelta(hours=7)).strftime("%Y-%m-%d %H:%M:%S")
 
-    sections = soup.find_all("div", id=lambda x: x and x.strip() in ["GALERI 24", "ANTAM", "Dinar G24", "ANTAM NON PEGADAIAN", "UBS"]) # Insert more gold brand here, check DIV id on the website
+    sections = parse_sections_fast(resp.content)
+    if sections is None:
+        logging.info("Row markup did not match the regex fast path, parsing with lxml")
+        sections = parse_sections_lxml(resp.content)
     if not sections:
         logging.warning("No sections found. Check the page structure.")
         return pd.DataFrame(columns=["timestamp", "brand", "weight", "harga_jual", "harga_buyback"])
 
-    all_data = []
-    for sec in sections:
-        brand = sec.get("id").strip()
-        try:
-            all_data.extend(parse_table(sec, brand, timestamp_iso))
-        except Exception as e:
-            logging.warning("Failed to parse section %s: %s", brand, e)
+    brand_list, weight_list, jual_list, buyback_list = [], [], [], []
+    for brand, rows in sections:
+        for weight, jual, buyback in rows:
+            brand_list.append(brand)
+            weight_list.append(weight)
+            jual_list.append(jual)
+            buyback_list.append(buyback)
 
-    if not all_data:
+    if not brand_list:
         logging.warning("No rows parsed. Check selectors/HTML structure.")
         return pd.DataFrame(columns=["timestamp", "brand", "weight", "harga_jual", "harga_buyback"])
 
-    df = pd.DataFrame(all_data, columns=["timestamp", "brand", "weight", "harga_jual", "harga_buyback"])
+    # column-wise construction, the scalar timestamp is broadcast by pandas
+    df = pd.DataFrame({
+        "timestamp": timestamp_iso,
+        "brand": brand_list,
+        "weight": weight_list,
+        "harga_jual": jual_list,
+        "harga_buyback": buyback_list,
+    })
 
-    df["harga_jual"] = df["harga_jual"].apply(parse_currency_to_int)
-    df["harga_buyback"] = df["harga_buyback"].apply(parse_currency_to_int)
+    prices = {col: df[col].str.translate(_PRICE_DELETE) for col in ("harga_jual", "harga_buyback")}
+    valid = (
+        prices["harga_jual"].str.isascii() & prices["harga_jual"].str.isdigit()
+        & prices["harga_buyback"].str.isascii() & prices["harga_buyback"].str.isdigit()
+    )
     before = len(df)
-    df = df.dropna(subset=["harga_jual", "harga_buyback"]).reset_index(drop=True)
+    df = df[valid].reset_index(drop=True)
     logging.info("Parsed %d rows, %d dropped due to missing price", before, before - len(df))
-    df["harga_jual"] = df["harga_jual"].astype(int)
-    df["harga_buyback"] = df["harga_buyback"].astype(int)
+    for col, digits in prices.items():
+        # int32 when it fits; 1 kg bars can exceed 2^31 IDR, so int64 stays as fallback
+        df[col] = pd.to_numeric(digits[valid], downcast="integer").to_numpy()
 
-    df["timestamp_local"] = (pd.to_datetime(df["timestamp"], utc=True) + timedelta(hours=7)).dt.strftime("%Y-%m-%d %H:%M:%S")
+    df["timestamp_local"] = timestamp_local
 
     df = df[["timestamp", "timestamp_local", "brand", "weight", "harga_jual", "harga_buyback"]]
     
@@ -132,49 +226,77 @@ def auth_gspread_from_env():
     if not json_str:
         raise RuntimeError("GCP_SERVICE_ACCOUNT_JSON is not set in environment")
 
-    with tempfile.NamedTemporaryFile(mode="w+", suffix=".json", delete=False) as f:
-        f.write(json_str)
-        SERVICE_ACCOUNT_PATH = f.name
-
-    gc = gspread.service_account(filename=SERVICE_ACCOUNT_PATH)
+    gc = gspread.service_account_from_dict(orjson.loads(json_str))
     return gc
 
 
-def append_to_sheet(df):
+def read_last_ts():
+    try:
+        with open(LAST_TS_PATH) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def write_last_ts(ts):
+    with open(LAST_TS_PATH, "w") as f:
+        f.write(ts)
+
+def drop_existing(df, is_new):
+    before = len(df)
+    df = df[is_new]
+    if before != len(df):
+        logging.info("Dropped %d duplicate rows", before - len(df))
+    return df
+
+def append_to_sheet(df, read_back=False):
     if df.empty:
         logging.info("No data to append.")
         return 0
+
+    # rows from a previous run are always older than this run's timestamp, so
+    # .last_ts only guards against re-appending them. A retry may follow an
+    # append the server kept but answered with an error, so the caller passes
+    # read_back=True and the sheet itself is checked instead.
+    last_ts = None if read_back else read_last_ts()
+    if last_ts is not None:
+        df = drop_existing(df, df["timestamp"] > last_ts)
+        if df.empty:
+            logging.info("All rows already exist, skipping append.")
+            return 0
     
     gc = auth_gspread_from_env()
     sh = gc.open_by_key(SHEET_ID)
     ws = sh.worksheet(WORKSHEET_NAME)
 
-    existing = ws.get_all_values()
-    row_count = len(existing)
-    start_row = row_count + 1
-    if existing:
-        header = existing[0]
-        if "timestamp" in header:
-            ts_idx = header.index("timestamp")
-            existing_ts = {
-                row[ts_idx]
-                for row in existing[1:]
-                if len(row) > ts_idx
-            }
-            before = len(df)
-            df = df[~df["timestamp"].isin(existing_ts)]
-            if before != len(df):
-                logging.info("Dropped %d duplicate rows", before - len(df))
+    landed = 0
+    if last_ts is None:
+        # no local state (first run or cache miss) or a retry: fall back to
+        # reading the timestamp column only
+        existing_ts = set(ws.col_values(TS_COL_IDX + 1)[1:])
+        is_new = ~df["timestamp"].isin(existing_ts)
+        if read_back and not is_new.all():
+            # this run's timestamps are fresh, so matches were written by the failed attempt
+            landed = int((~is_new).sum())
+            write_last_ts(df.loc[~is_new, "timestamp"].max())
+            logging.info("%d rows were already written by a previous attempt", landed)
+        df = drop_existing(df, is_new)
     
     if df.empty:
         logging.info("All rows already exist, skipping append.")
-        return 0
+        return landed
     
-    set_with_dataframe(ws, df, row=start_row, include_column_header=False)
-    logging.info("Appended %d rows. Total rows now: %d", len(df), row_count + len(df))
-    return len(df)
+    resp = ws.append_rows(
+        df.values.tolist(),
+        value_input_option="USER_ENTERED",
+        insert_data_option="INSERT_ROWS",
+    )
+    write_last_ts(df["timestamp"].max())
+    logging.info("Appended %d rows at %s", len(df), resp.get("updates", {}).get("updatedRange"))
+    return landed + len(df)
 
 if __name__ == "__main__":
     df = scrape()
-    appended = retry_gspread(lambda: append_to_sheet(df))
+    attempts = itertools.count(1)
+    # every retry reads the sheet back in case the failed attempt's append landed
+    appended = retry_gspread(lambda: append_to_sheet(df, read_back=next(attempts) > 1))
     logging.info("Done. Appended %d rows.", appended)